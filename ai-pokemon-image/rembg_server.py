@@ -3,34 +3,279 @@ DeepLab Backend Server for React App
 Run this server to process semantic segmentation using DeepLab for people detection
 
 Installation:
-    pip install flask flask-cors pillow numpy torch torchvision
+    pip install flask flask-cors pillow numpy torch torchvision waitress
 
 Usage:
     python rembg_server.py
+    # or with gunicorn (keep a single worker so the model is loaded once)
+    gunicorn -w 1 --threads 8 -b 0.0.0.0:5001 rembg_server:app
 """
 
 from flask import Flask, request, send_file
 from flask_cors import CORS
 from io import BytesIO
 from PIL import Image
+from concurrent.futures import Future
 import numpy as np
 import os
+import queue
+import threading
+import time
 import torch
-import torchvision.transforms as transforms
+import torch.nn.functional as F
 from torchvision.models.segmentation import deeplabv3_resnet50, DeepLabV3_ResNet50_Weights
 
+try:
+    from numba import njit, prange
+except ImportError:
+    # numba is optional - the NumPy classifier is used without it
+    njit = None
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    jpeg_decoder = TurboJPEG()
+except Exception:
+    # PyTurboJPEG (and the libturbojpeg library it loads) are optional - Pillow decodes JPEGs without them
+    jpeg_decoder = None
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for React app
 
+# Concurrent requests are coalesced into one DeepLab forward pass of up to MAX_BATCH images
+MAX_BATCH = int(os.environ.get('DEEPLAB_MAX_BATCH', 8))
+# How long the batch worker waits for more requests after the first one arrives
+MAX_WAIT_MS = 5
+# Longest image side passed to DeepLab, larger images are downscaled for inference
+MAX_INPUT_SIDE = 1024
+# Fixed input sizes (H, W), smallest area first, covering common aspect ratios after the MAX_INPUT_SIDE cap.
+# Only used for the CUDA-graph compiled model, which records one graph per shape - each input is padded to
+# the smallest bucket that fits. Other backends run every input at its exact size
+INPUT_SIZE_BUCKETS = [
+    (384, 512), (512, 384), (512, 512),
+    (480, 640), (640, 480),
+    (576, 1024), (1024, 576), (768, 768),
+    (768, 1024), (1024, 768), (1024, 1024),
+]
+# Fixed batch sizes for the CUDA-graph compiled model - its batches are padded with blank inputs up to the
+# smallest one that fits. Other backends run batches at their actual size
+BATCH_SIZE_BUCKETS = [n for n in (1, 2, 4) if n < MAX_BATCH] + [MAX_BATCH]
+# Longest a request waits for its inference result before falling back to color segmentation
+INFERENCE_TIMEOUT_S = 60
+# Request handler threads for the WSGI server
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 8))
+
+# TensorRT engine cache (used automatically when tensorrt is installed and CUDA is available)
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+DEEPLAB_ONNX_PATH = os.environ.get('DEEPLAB_ONNX_PATH', os.path.join(MODEL_DIR, 'deeplab.onnx'))
+DEEPLAB_TRT_PATH = os.environ.get('DEEPLAB_TRT_PATH', os.path.join(MODEL_DIR, 'deeplab.trt'))
+# Input shapes (N, C, H, W) covered by the TensorRT optimization profile
+TRT_MIN_SHAPE = (1, 3, 64, 64)
+TRT_OPT_SHAPE = (1, 3, 512, 512)
+TRT_MAX_SHAPE = (MAX_BATCH, 3, MAX_INPUT_SIDE, MAX_INPUT_SIDE)
+
+# Segmentation labels - every pixel gets exactly one
+LABEL_OTHER = 0
+LABEL_SUBJECT = 1
+LABEL_SKY = 2
+LABEL_GROUND = 3
+
+# Segmentation mask colors, indexed by label
+SEGMENTATION_PALETTE = np.array([
+    [255, 255, 0],  # Other = yellow (other background like walls, buildings)
+    [255, 0, 255],  # Subject = magenta/pink (foreground objects) - more distinct from red
+    [0, 255, 255],  # Sky = cyan (top background) - more distinct from blue
+    [255, 165, 0],  # Ground = orange (bottom background) - more distinct from green
+], dtype=np.uint8)
+
 # Initialize DeepLab model
 deeplab_model = None
 device = None
+# ImageNet normalization constants on the model device, scaled to 0-255 pixel values
+input_mean = None
+input_std = None
+# Pending (input_tensor, Future) pairs for the batch worker
+inference_queue = queue.Queue()
+# True when deeplab_model is the torch.compile CUDA-graph wrapper, which needs bucketed input shapes
+uses_cuda_graphs = False
+
+class TensorRTDeepLab:
+    """Run a serialized TensorRT DeepLab engine with the same call signature as the PyTorch model"""
+    
+    def __init__(self, engine_path, fallback_model):
+        import tensorrt as trt
+        
+        logger = trt.Logger(trt.Logger.WARNING)
+        with open(engine_path, 'rb') as f:
+            self.engine = trt.Runtime(logger).deserialize_cuda_engine(f.read())
+        if self.engine is None:
+            raise RuntimeError(f"Could not deserialize TensorRT engine {engine_path}")
+        self.context = self.engine.create_execution_context()
+        # Inputs outside the optimization profile go through the PyTorch model
+        self.min_shape, _, self.max_shape = self.engine.get_tensor_profile_shape('input', 0)
+        self.fallback_model = fallback_model
+    
+    def __call__(self, input_tensor):
+        shape = tuple(input_tensor.shape)
+        if any(s < lo or s > hi for s, lo, hi in zip(shape, self.min_shape, self.max_shape)):
+            return self.fallback_model(input_tensor)
+        
+        # Engine I/O is FP32 - FP16 is used internally by the engine's kernels
+        input_tensor = input_tensor.float().contiguous()
+        self.context.set_input_shape('input', shape)
+        output = torch.empty(tuple(self.context.get_tensor_shape('out')), dtype=torch.float32, device=input_tensor.device)
+        
+        # Bindings follow the engine's I/O order: input, out
+        if not self.context.execute_v2([input_tensor.data_ptr(), output.data_ptr()]):
+            raise RuntimeError("TensorRT inference failed")
+        return {'out': output}
+
+def build_tensorrt_engine(model, onnx_path, engine_path):
+    """Export DeepLab to ONNX and build an FP16 TensorRT engine with dynamic input size"""
+    import tensorrt as trt
+    
+    class _OutOnly(torch.nn.Module):
+        # Export only the main head - the auxiliary classifier is not used for inference
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+        
+        def forward(self, x):
+            return self.model(x)['out']
+    
+    dummy_input = torch.zeros(TRT_OPT_SHAPE, device=device)
+    torch.onnx.export(
+        _OutOnly(model), dummy_input, onnx_path,
+        opset_version=17,
+        input_names=['input'],
+        output_names=['out'],
+        dynamic_axes={'input': {0: 'n', 2: 'h', 3: 'w'}, 'out': {0: 'n', 2: 'h', 3: 'w'}},
+    )
+    
+    logger = trt.Logger(trt.Logger.WARNING)
+    builder = trt.Builder(logger)
+    network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+    parser = trt.OnnxParser(network, logger)
+    if not parser.parse_from_file(onnx_path):
+        errors = [str(parser.get_error(i)) for i in range(parser.num_errors)]
+        raise RuntimeError(f"Could not parse {onnx_path}: {errors}")
+    
+    config = builder.create_builder_config()
+    config.set_flag(trt.BuilderFlag.FP16)
+    profile = builder.create_optimization_profile()
+    profile.set_shape('input', TRT_MIN_SHAPE, TRT_OPT_SHAPE, TRT_MAX_SHAPE)
+    config.add_optimization_profile(profile)
+    
+    serialized_engine = builder.build_serialized_network(network, config)
+    if serialized_engine is None:
+        raise RuntimeError("TensorRT engine build failed")
+    with open(engine_path, 'wb') as f:
+        f.write(serialized_engine)
+
+def load_tensorrt_model(model):
+    """Wrap the model with a cached TensorRT engine, building it on first run. Returns the model unchanged if unavailable"""
+    if device != 'cuda':
+        return model
+    try:
+        import tensorrt  # noqa: F401
+    except ImportError:
+        return model
+    
+    try:
+        if not os.path.exists(DEEPLAB_TRT_PATH):
+            print(f"Building TensorRT engine at {DEEPLAB_TRT_PATH} (first run only, this can take several minutes)")
+            build_tensorrt_engine(model, DEEPLAB_ONNX_PATH, DEEPLAB_TRT_PATH)
+        trt_model = TensorRTDeepLab(DEEPLAB_TRT_PATH, model)
+        print("DeepLab running with TensorRT FP16 engine")
+        return trt_model
+    except Exception as e:
+        print(f"Error loading TensorRT engine, using PyTorch model: {e}")
+        return model
+
+def size_bucket(height, width):
+    """Return the smallest INPUT_SIZE_BUCKETS entry that fits (height, width), or the size itself if none does"""
+    for bucket_height, bucket_width in INPUT_SIZE_BUCKETS:
+        if height <= bucket_height and width <= bucket_width:
+            return bucket_height, bucket_width
+    return height, width
+
+def inference_worker():
+    """Pull queued inputs, run them through DeepLab in one batch per input size, and resolve each request's Future"""
+    while True:
+        items = [inference_queue.get()]
+        deadline = time.monotonic() + MAX_WAIT_MS / 1000
+        while len(items) < MAX_BATCH:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(inference_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        
+        # Only inputs of the same size share a forward pass - padding would change the result, since
+        # DeepLab's ASPP pooling averages over the whole input. The CUDA-graph model is the exception:
+        # it pads to size buckets to bound the number of recorded graphs
+        groups = {}
+        for tensor, future in items:
+            height, width = tensor.shape[2], tensor.shape[3]
+            key = size_bucket(height, width) if uses_cuda_graphs else (height, width)
+            groups.setdefault(key, []).append((tensor, future))
+        
+        for (batch_height, batch_width), group in groups.items():
+            try:
+                # Pad inputs on the bottom/right to their bucket size (a no-op unless bucketing)
+                batch = torch.cat([
+                    F.pad(tensor, (0, batch_width - tensor.shape[3], 0, batch_height - tensor.shape[2]))
+                    for tensor, _ in group
+                ])
+                if uses_cuda_graphs:
+                    # Pad the batch dimension too, so the compiled model only records len(BATCH_SIZE_BUCKETS) batch sizes
+                    batch_size = next(n for n in BATCH_SIZE_BUCKETS if n >= len(group))
+                    if batch_size > len(group):
+                        batch = F.pad(batch, (0, 0, 0, 0, 0, 0, 0, batch_size - len(group)))
+                
+                # Run inference, in FP16 on GPU
+                with torch.inference_mode(), torch.autocast(device_type=device, dtype=torch.float16, enabled=device == 'cuda'):
+                    outputs = deeplab_model(batch)['out']
+                
+                for (tensor, future), output in zip(group, outputs):
+                    # Copy out of the model's output buffer - a compiled (CUDA graph) model reuses it on the next batch
+                    future.set_result(output[:, :tensor.shape[2], :tensor.shape[3]].clone())
+            except Exception as e:
+                for _, future in group:
+                    future.set_exception(e)
+
+def submit_deeplab(input_tensor):
+    """Queue a (1, 3, H, W) normalized input for batched inference, returning a Future for its (classes, H, W) output"""
+    future = Future()
+    inference_queue.put((input_tensor, future))
+    return future
+
+def run_deeplab(input_tensor):
+    """Queue a (1, 3, H, W) normalized input for batched inference and wait for its (classes, H, W) output"""
+    return submit_deeplab(input_tensor).result(timeout=INFERENCE_TIMEOUT_S)
+
+def warmup_deeplab_model():
+    """Run dummy inputs through the batch worker so compilation and cuDNN autotuning happen before the first request"""
+    # For the CUDA-graph model every (batch size, input size) bucket pair is exactly one shape it will see.
+    # Other backends run whatever batch size arrives, so warming the common input sizes once is enough
+    batch_sizes = BATCH_SIZE_BUCKETS if uses_cuda_graphs else [1]
+    for size in INPUT_SIZE_BUCKETS:
+        for batch_size in batch_sizes:
+            # Queue the whole batch at once so the worker runs it as one forward pass
+            futures = [submit_deeplab(torch.zeros(1, 3, *size, device=device)) for _ in range(batch_size)]
+            for future in futures:
+                # No timeout - the first pass through a compiled model can take minutes
+                future.result()
 
 def load_deeplab_model():
     """Load DeepLab model for semantic segmentation"""
-    global deeplab_model, device
+    global deeplab_model, device, input_mean, input_std, uses_cuda_graphs
     try:
         device = "cuda" if torch.cuda.is_available() else "cpu"
+        if 'TORCH_NUM_THREADS' in os.environ:
+            # Inference only runs on the batch worker thread, so PyTorch's default (all cores) is usually right
+            torch.set_num_threads(int(os.environ['TORCH_NUM_THREADS']))
         
         # Load DeepLabV3 with ResNet50 backbone (pre-trained on COCO)
         # COCO classes include: person (class 15), sky, ground, etc.
@@ -38,6 +283,37 @@ def load_deeplab_model():
         deeplab_model.to(device)
         deeplab_model.eval()
         
+        input_mean = torch.tensor([0.485, 0.456, 0.406], device=device).view(1, 3, 1, 1) * 255
+        input_std = torch.tensor([0.229, 0.224, 0.225], device=device).view(1, 3, 1, 1) * 255
+        
+        # Start the batch worker before anything optional that can fail, so queued requests are always served
+        threading.Thread(target=inference_worker, daemon=True).start()
+        
+        eager_model = deeplab_model
+        deeplab_model = load_tensorrt_model(deeplab_model)
+        if device == 'cuda':
+            # Let cuDNN pick the fastest conv algorithms per input shape
+            torch.backends.cudnn.benchmark = True
+            if deeplab_model is eager_model:
+                try:
+                    # Fuse ops and replay CUDA graphs instead of launching each small kernel from Python
+                    deeplab_model = torch.compile(deeplab_model, mode='reduce-overhead', fullgraph=False)
+                    uses_cuda_graphs = True
+                except Exception as e:
+                    print(f"torch.compile unavailable, using eager PyTorch: {e}")
+        
+        # Compilation happens lazily, on the worker thread that will also serve requests.
+        # Only worth it on GPU - on CPU there is no cuDNN autotuning or compiled model to prepare
+        if device == 'cuda':
+            try:
+                warmup_deeplab_model()
+            except Exception as e:
+                print(f"Error warming up DeepLab model: {e}")
+                if deeplab_model is not eager_model:
+                    print("Falling back to the eager PyTorch model")
+                    deeplab_model = eager_model
+                    uses_cuda_graphs = False
+        
         print(f"DeepLab model loaded successfully on {device}")
         print("Model is pre-trained on COCO dataset with person detection")
         return True
@@ -45,206 +321,255 @@ def load_deeplab_model():
         print(f"Error loading DeepLab model: {e}")
         import traceback
         traceback.print_exc()
+        # Don't leave a half-initialized model behind - requests must take the fallback path
+        deeplab_model = None
         return False
 
 # Try to load DeepLab model on startup
 if not load_deeplab_model():
     print("Falling back to simple color-based segmentation")
 
-def simple_sky_ground_segmentation(image):
-    """Simple color-based segmentation fallback - returns subject (people-focused), sky, ground, other"""
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
+def _rgb_int16(img_array):
+    """Split an RGB array into int16 channels, so sums like r + g + b (max 765) cannot overflow uint8"""
+    # Keep threshold constants as Python ints so NumPy stays in int16 instead of upcasting
+    img_array = img_array.astype(np.int16, copy=False)
+    return img_array[..., 0], img_array[..., 1], img_array[..., 2]
+
+def _classify_bg(r, g, b):
+    """Classify pixels from their int16 channels into sky and ground (boolean HxW arrays, mutually exclusive, the rest is other)"""
+    # Compare against 3x the brightness thresholds to keep the original (r + g + b) / 3 semantics in integers
+    rgb_sum = r + g + b
+    saturation = np.maximum(np.maximum(r, g), b) - np.minimum(np.minimum(r, g), b)
+    
+    # Sky detection: bright, blue-ish
+    # Sky characteristics: high brightness, blue dominant, low saturation variation
+    # Check sky FIRST before ground to avoid misclassification
+    # Very lenient sky detection - prioritize detecting sky correctly
+    sky = (
+        (rgb_sum > 3 * 80) &  # Bright (very lenient)
+        (b > 80) &  # Some blue component (very lenient)
+        ((b >= r) | (b >= g)) &  # Blue is at least equal to or higher than one other component
+        ((b > r + 5) | (b > g + 5)) &  # Blue is somewhat dominant (very lenient)
+        (saturation < 180)  # Not too colorful (sky is usually uniform, very lenient)
+    )
     
-    img_array = np.array(image)
-    height, width = img_array.shape[:2]
+    # Ground detection: green (grass) or brown (dirt/road)
+    # Ground characteristics: green or brown, medium brightness
+    # CRITICAL: Explicitly exclude ANY blue-dominant pixels - blue MUST be low
+    is_green_dominant = (g > r + 20) & (g > b + 20)
+    is_brownish = (r > 100) & (g > 80) & (b < 100) & (np.abs(r - g) < 30)
     
-    sky_mask = np.zeros((height, width), dtype=np.uint8)
-    ground_mask = np.zeros((height, width), dtype=np.uint8)
-    other_mask = np.zeros((height, width), dtype=np.uint8)
-    subject_mask = np.zeros((height, width), dtype=np.uint8)
+    # Ground must NOT be sky-like - blue must be LOW (this is the key separation)
+    ground = (
+        ~sky &  # NOT sky (double check)
+        (b < 90) &  # Blue is LOW (critical for separating from sky - lowered threshold)
+        (
+            (is_green_dominant & (g > 100) & (rgb_sum < 3 * 230)) |  # Grass
+            (is_brownish & (rgb_sum < 3 * 200)) |  # Dirt/road
+            ((g > 90) & (r > 70) & (b < 80) & (rgb_sum < 3 * 210) & (b < r) & (b < g)) |  # Earth tones (blue is lowest)
+            ((r > 80) & (g > 70) & (b < 70) & (rgb_sum < 3 * 190))  # Darker earth tones (very low blue)
+        )
+    )
+    
+    return sky, ground
+
+def _resize_nearest(array, height, width):
+    """Nearest-neighbor resize of a 2D array (class map or mask) to (height, width) using index arrays, keeping its dtype"""
+    src_h, src_w = array.shape[:2]
+    # Sample at pixel centers, same as PIL's NEAREST filter
+    iy = (2 * np.arange(height) + 1) * src_h // (2 * height)
+    ix = (2 * np.arange(width) + 1) * src_w // (2 * width)
+    return array[iy[:, None], ix[None, :]]
+
+def _color_subject(r, g, b):
+    """Detect people-like pixels (skin tones or clothing colors) from int16 channels, as a boolean HxW array"""
+    rgb_sum = r + g + b
     
-    for y in range(height):
-        for x in range(width):
-            r, g, b = img_array[y, x, :3]
-            brightness = (r + g + b) / 3
-            saturation = max(r, g, b) - min(r, g, b) if brightness > 0 else 0
-            
-            # Sky detection: bright, blue-ish
-            # Check sky FIRST - sky takes priority
-            # Very lenient sky detection - prioritize detecting sky correctly
-            is_sky_like = (
-                brightness > 80 and  # Bright (very lenient)
-                b > 80 and  # Some blue component (very lenient)
-                (b >= r or b >= g) and  # Blue is at least equal to or higher than one other component
-                (b > r + 5 or b > g + 5) and  # Blue is somewhat dominant (very lenient)
-                saturation < 180  # Not too colorful (very lenient)
-            )
-            
-            # Ground detection: green (grass) or brown (dirt/road)
-            # CRITICAL: Explicitly exclude ANY blue-dominant pixels - blue MUST be low
-            is_green_dominant = g > r + 20 and g > b + 20
-            is_brownish = r > 100 and g > 80 and b < 100 and abs(r - g) < 30
-            
-            # Ground must NOT be sky-like - blue must be LOW (this is the key separation)
-            is_ground_like = (
-                not is_sky_like and  # NOT sky (double check)
-                b < 90 and  # Blue is LOW (critical for separating from sky - lowered threshold)
-                (
-                    (is_green_dominant and g > 100 and brightness < 230) or  # Grass
-                    (is_brownish and brightness < 200) or  # Dirt/road
-                    (g > 90 and r > 70 and b < 80 and brightness < 210 and b < r and b < g) or  # Earth tones (blue is lowest)
-                    (r > 80 and g > 70 and b < 70 and brightness < 190)  # Darker earth tones (very low blue)
+    is_green_dominant = (g > r + 20) & (g > b + 20)
+    is_blue_dominant = (b > r + 20) & (b > g + 20)
+    is_brownish = (r > 100) & (g > 80) & (b < 100) & (np.abs(r - g) < 30)
+    
+    # People detection: skin tones or clothing colors
+    is_skin_tone = (r > 150) & (g > 100) & (b > 80) & (r > g) & (r > b)
+    is_clothing_color = (
+        (rgb_sum > 3 * 80) & (rgb_sum < 3 * 220) &
+        ~is_blue_dominant &
+        ~is_green_dominant &
+        ~is_brownish
+    )
+    return is_skin_tone | is_clothing_color
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _classify_numba(img_array, person, labels):
+        """Fused single-pass version of _color_subject + _classify_bg, writing into the preallocated labels
+
+        An empty person array means the subject is detected by color, as in the fallback segmentation.
+        """
+        use_person = person.shape[0] > 0
+        for y in prange(img_array.shape[0]):
+            for x in range(img_array.shape[1]):
+                r = np.int32(img_array[y, x, 0])
+                g = np.int32(img_array[y, x, 1])
+                b = np.int32(img_array[y, x, 2])
+                rgb_sum = r + g + b
+                saturation = max(r, g, b) - min(r, g, b)
+                is_green_dominant = g > r + 20 and g > b + 20
+                is_brownish = r > 100 and g > 80 and b < 100 and abs(r - g) < 30
+                
+                if use_person:
+                    is_subject = person[y, x]
+                else:
+                    is_blue_dominant = b > r + 20 and b > g + 20
+                    is_skin_tone = r > 150 and g > 100 and b > 80 and r > g and r > b
+                    is_clothing_color = (
+                        rgb_sum > 3 * 80 and rgb_sum < 3 * 220 and
+                        not is_blue_dominant and
+                        not is_green_dominant and
+                        not is_brownish
+                    )
+                    is_subject = is_skin_tone or is_clothing_color
+                
+                is_sky_like = (
+                    rgb_sum > 3 * 80 and
+                    b > 80 and
+                    (b >= r or b >= g) and
+                    (b > r + 5 or b > g + 5) and
+                    saturation < 180
+                )
+                is_ground_like = (
+                    b < 90 and
+                    (
+                        (is_green_dominant and g > 100 and rgb_sum < 3 * 230) or
+                        (is_brownish and rgb_sum < 3 * 200) or
+                        (g > 90 and r > 70 and b < 80 and rgb_sum < 3 * 210 and b < r and b < g) or
+                        (r > 80 and g > 70 and b < 70 and rgb_sum < 3 * 190)
+                    )
                 )
-            )
-            
-            # People detection: skin tones or clothing colors
-            is_skin_tone = (r > 150 and g > 100 and b > 80 and r > g and r > b)
-            is_clothing_color = (
-                brightness > 80 and brightness < 220 and
-                not is_blue_dominant and
-                not is_green_dominant and
-                not is_brownish
-            )
-            
-            # Classify
-            if is_skin_tone or is_clothing_color:
-                subject_mask[y, x] = 255
-            elif is_sky_like:
-                sky_mask[y, x] = 255
-            elif is_ground_like:
-                ground_mask[y, x] = 255
-            else:
-                other_mask[y, x] = 255
+                
+                if is_subject:
+                    labels[y, x] = LABEL_SUBJECT
+                elif is_sky_like:
+                    labels[y, x] = LABEL_SKY
+                elif is_ground_like:
+                    labels[y, x] = LABEL_GROUND
+                else:
+                    labels[y, x] = LABEL_OTHER
+else:
+    _classify_numba = None
+
+# numba's parallel kernels must not be entered from several threads at once - its default "workqueue"
+# threading layer (used when neither TBB nor OpenMP is installed) aborts the process. The kernel already
+# uses every core, so running one image at a time costs little
+classify_lock = threading.Lock()
+
+def classify_pixels(img_array, person=None):
+    """Label every pixel of an RGB array as subject, sky, ground, or other (uint8 HxW array of LABEL_* values)
+
+    The subject is the given boolean person mask, or detected by color when person is None.
+    Uses the fused numba kernel when numba is installed, NumPy otherwise.
+    """
+    labels = np.empty(img_array.shape[:2], dtype=np.uint8)
+    
+    if _classify_numba is not None:
+        if person is None:
+            person = np.zeros((0, 0), dtype=np.bool_)
+        with classify_lock:
+            _classify_numba(img_array, person, labels)
+        return labels
+    
+    r, g, b = _rgb_int16(img_array)
+    if person is None:
+        person = _color_subject(r, g, b)
+    
+    # Classify - subject takes priority over the background categories
+    sky, ground = _classify_bg(r, g, b)
+    labels.fill(LABEL_OTHER)
+    labels[ground] = LABEL_GROUND
+    labels[sky] = LABEL_SKY
+    labels[person] = LABEL_SUBJECT
     
-    return subject_mask, sky_mask, ground_mask, other_mask
+    return labels
 
-def segment_with_deeplab(image):
-    """Use DeepLab to segment image into subject (people), sky, ground, and other"""
+# Compile the numba classifier for both subject modes now rather than on the first request (no-op without numba)
+classify_pixels(np.zeros((1, 1, 3), dtype=np.uint8))
+classify_pixels(np.zeros((1, 1, 3), dtype=np.uint8), np.zeros((1, 1), dtype=np.bool_))
+
+def decode_image(data):
+    """Decode uploaded image bytes into an HxWx3 uint8 RGB array"""
+    if jpeg_decoder is not None and data[:3] == b'\xff\xd8\xff':
+        try:
+            return jpeg_decoder.decode(data, pixel_format=TJPF_RGB)
+        except Exception:
+            # e.g. CMYK or progressive edge cases libjpeg-turbo rejects - let Pillow try
+            pass
+    return np.array(Image.open(BytesIO(data)).convert('RGB'))
+
+def simple_sky_ground_segmentation(img_array):
+    """Simple color-based segmentation fallback - returns labels for subject (people-focused), sky, ground, other"""
+    return classify_pixels(img_array)
+
+def segment_with_deeplab(img_array):
+    """Use DeepLab to segment an RGB array into subject (people), sky, ground, and other labels"""
     if deeplab_model is None:
-        return simple_sky_ground_segmentation(image)
+        return simple_sky_ground_segmentation(img_array)
     
     try:
-        # Convert PIL to numpy array
-        img_array = np.array(image.convert('RGB'))
         height, width = img_array.shape[:2]
+        full_array = img_array
         
-        # Preprocess image for DeepLab
-        # DeepLab expects normalized input
-        preprocess = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
-        
-        input_tensor = preprocess(image).unsqueeze(0).to(device)
-        
-        # Run inference
-        with torch.no_grad():
-            output = deeplab_model(input_tensor)['out'][0]
+        # Cap the resolution DeepLab sees - cost grows with H x W but detail beyond ~1024px does not help.
+        # Labels are computed at the reduced size and upsampled at the end
+        scale = min(1.0, MAX_INPUT_SIDE / max(height, width))
+        if scale < 1:
+            small_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            img_array = np.array(Image.fromarray(img_array).resize(small_size, Image.BILINEAR))
+        infer_height, infer_width = img_array.shape[:2]
         
-        # Get predicted classes
-        # COCO classes: 0=background, 15=person, and other classes
-        # We'll map: person=subject, sky/ground/other based on position and color
-        predictions = output.argmax(0).cpu().numpy()
-        
-        # Resize predictions to match original image if needed
-        if predictions.shape[0] != height or predictions.shape[1] != width:
-            pred_image = Image.fromarray(predictions.astype(np.uint8))
-            pred_image = pred_image.resize((width, height), Image.NEAREST)
-            predictions = np.array(pred_image)
+        # Preprocess image for DeepLab
+        # Upload as uint8 (4x less transfer than float32) and normalize on the device
+        input_tensor = torch.from_numpy(img_array)
+        if device == 'cuda':
+            # Stage in pinned memory so the copy is a real async DMA - PyTorch caches pinned blocks between requests
+            input_tensor = input_tensor.pin_memory()
+        input_tensor = input_tensor.to(device, non_blocking=True)
+        input_tensor = input_tensor.permute(2, 0, 1).unsqueeze(0).float()
+        input_tensor = (input_tensor - input_mean) / input_std
         
-        # Initialize masks
-        sky_mask = np.zeros((height, width), dtype=np.uint8)
-        ground_mask = np.zeros((height, width), dtype=np.uint8)
-        other_mask = np.zeros((height, width), dtype=np.uint8)
-        subject_mask = np.zeros((height, width), dtype=np.uint8)
+        # Run inference, batched with other concurrent requests
+        output = run_deeplab(input_tensor)
         
         # COCO class IDs (from DeepLab COCO weights):
         # 0 = background, 15 = person
         PERSON_CLASS = 15
         
-        # First pass: identify people
-        for y in range(height):
-            for x in range(width):
-                class_id = predictions[y, x]
-                if class_id == PERSON_CLASS:
-                    subject_mask[y, x] = 255
+        # Only person vs. not-person matters, so compare on the device and copy back a bool mask
+        # instead of the int64 class map
+        person = (output.argmax(0) == PERSON_CLASS).cpu().numpy()
         
-        # Second pass: classify background pixels using intelligent detection
-        for y in range(height):
-            for x in range(width):
-                # Skip if already classified as person
-                if subject_mask[y, x] == 255:
-                    continue
-                
-                class_id = predictions[y, x]
-                r, g, b = img_array[y, x, :3]
-                brightness = (r + g + b) / 3
-                
-                # Calculate color characteristics
-                saturation = max(r, g, b) - min(r, g, b) if brightness > 0 else 0
-                
-                # Sky detection: bright, blue-ish
-                # Sky characteristics: high brightness, blue dominant, low saturation variation
-                # Check sky FIRST before ground to avoid misclassification
-                # Very lenient sky detection - prioritize detecting sky correctly
-                is_sky_like = (
-                    brightness > 80 and  # Bright (very lenient)
-                    b > 80 and  # Some blue component (very lenient)
-                    (b >= r or b >= g) and  # Blue is at least equal to or higher than one other component
-                    (b > r + 5 or b > g + 5) and  # Blue is somewhat dominant (very lenient)
-                    saturation < 180  # Not too colorful (sky is usually uniform, very lenient)
-                )
-                
-                # Ground detection: green (grass) or brown (dirt/road)
-                # Ground characteristics: green or brown, medium brightness
-                # CRITICAL: Explicitly exclude ANY blue-dominant pixels - blue MUST be low
-                is_green_dominant = g > r + 20 and g > b + 20
-                is_brownish = r > 100 and g > 80 and b < 100 and abs(r - g) < 30
-                
-                # Ground must NOT be sky-like - blue must be LOW (this is the key separation)
-                is_ground_like = (
-                    not is_sky_like and  # NOT sky (double check)
-                    b < 90 and  # Blue is LOW (critical for separating from sky - lowered threshold)
-                    (
-                        (is_green_dominant and g > 100 and brightness < 230) or  # Grass
-                        (is_brownish and brightness < 200) or  # Dirt/road
-                        (g > 90 and r > 70 and b < 80 and brightness < 210 and b < r and b < g) or  # Earth tones (blue is lowest)
-                        (r > 80 and g > 70 and b < 70 and brightness < 190)  # Darker earth tones (very low blue)
-                    )
-                )
-                
-                # Classify based on actual visual features - sky takes priority
-                if is_sky_like:
-                    sky_mask[y, x] = 255
-                elif is_ground_like:
-                    ground_mask[y, x] = 255
-                else:
-                    # Other background (buildings, walls, objects, etc.)
-                    other_mask[y, x] = 255
+        # Resize person mask to match the inference image if needed
+        if person.shape != (infer_height, infer_width):
+            person = _resize_nearest(person, infer_height, infer_width)
         
-        return subject_mask, sky_mask, ground_mask, other_mask
+        # People come from DeepLab, background pixels are classified by color
+        labels = classify_pixels(img_array, person)
+        
+        # Upsample labels back to the original image size
+        if (infer_height, infer_width) != (height, width):
+            labels = _resize_nearest(labels, height, width)
+        return labels
     except Exception as e:
         print(f"Error in DeepLab segmentation: {e}")
         import traceback
         traceback.print_exc()
-        return simple_sky_ground_segmentation(image)
+        return simple_sky_ground_segmentation(full_array)
 
-def create_segmentation_mask(subject_mask, sky_mask, ground_mask, other_mask):
+def create_segmentation_mask(labels):
     """Create a colored segmentation mask image with distinct colors"""
-    height, width = sky_mask.shape
-    result = np.zeros((height, width, 3), dtype=np.uint8)
-    
-    # Subject = magenta/pink (foreground objects) - more distinct from red
-    result[subject_mask > 0] = [255, 0, 255]
-    # Sky = cyan (top background) - more distinct from blue
-    result[sky_mask > 0] = [0, 255, 255]
-    # Ground = orange (bottom background) - more distinct from green
-    result[ground_mask > 0] = [255, 165, 0]
-    # Other = yellow (other background like walls, buildings)
-    result[other_mask > 0] = [255, 255, 0]
-    
-    return Image.fromarray(result)
+    # Palette image - PNG stores 1 byte per pixel instead of 3 RGB bytes
+    result = Image.fromarray(labels)
+    result.putpalette(SEGMENTATION_PALETTE.tobytes())
+    return result
 
 @app.route('/segment', methods=['POST'])
 def segment():
@@ -258,17 +583,18 @@ def segment():
         if file.filename == '':
             return {'error': 'No file selected'}, 400
 
-        input_image = Image.open(file.stream).convert('RGB')
+        img_array = decode_image(file.read())
         
-        # Perform segmentation - returns subject, sky, ground, other
-        subject_mask, sky_mask, ground_mask, other_mask = segment_with_deeplab(input_image)
+        # Perform segmentation - labels each pixel as subject, sky, ground, or other
+        labels = segment_with_deeplab(img_array)
         
         # Create colored segmentation mask
-        segmentation_image = create_segmentation_mask(subject_mask, sky_mask, ground_mask, other_mask)
+        segmentation_image = create_segmentation_mask(labels)
         
         # Convert to bytes
         img_io = BytesIO()
-        segmentation_image.save(img_io, 'PNG')
+        # Fast zlib level - the few-color palette mask compresses well regardless
+        segmentation_image.save(img_io, 'PNG', compress_level=1, optimize=False)
         img_io.seek(0)
 
         return send_file(img_io, mimetype='image/png')
@@ -288,29 +614,27 @@ def remove_background():
         if file.filename == '':
             return {'error': 'No file selected'}, 400
 
-        input_image = Image.open(file.stream).convert('RGB')
+        img_array = decode_image(file.read())
         
-        # Segment image - returns subject, sky, ground, other
-        subject_mask, sky_mask, ground_mask, other_mask = segment_with_deeplab(input_image)
+        # Segment image - labels each pixel as subject, sky, ground, or other
+        labels = segment_with_deeplab(img_array)
         
         # Create output with transparent background (all background categories)
-        img_array = np.array(input_image)
-        combined_bg_mask = (sky_mask > 0) | (ground_mask > 0) | (other_mask > 0)
-        
-        # Convert to RGBA
-        rgba = np.zeros((img_array.shape[0], img_array.shape[1], 4), dtype=np.uint8)
-        rgba[:, :, :3] = img_array
-        rgba[:, :, 3] = 255  # Full opacity
-        rgba[combined_bg_mask, 3] = 0  # Transparent for background
+        subject = labels == LABEL_SUBJECT
+        alpha = subject.view(np.uint8) * np.uint8(255)
+        rgba = np.concatenate((img_array, alpha[..., None]), axis=2)
+        # Zero the color of transparent pixels - it is never visible and uniform runs compress to almost nothing
+        rgba[~subject] = 0
         
         output_image = Image.fromarray(rgba, 'RGBA')
 
         # Convert to bytes
+        # Lossless WebP encodes much faster than PNG and handles the transparent regions better
         img_io = BytesIO()
-        output_image.save(img_io, 'PNG')
+        output_image.save(img_io, 'WEBP', lossless=True, quality=100, method=0)
         img_io.seek(0)
 
-        return send_file(img_io, mimetype='image/png')
+        return send_file(img_io, mimetype='image/webp')
     
     except Exception as e:
         return {'error': str(e)}, 500
@@ -326,4 +650,5 @@ if __name__ == '__main__':
     print('Make sure dependencies are installed: pip install -r requirements.txt')
     if deeplab_model is None:
         print('Note: DeepLab model not loaded, using fallback segmentation')
-    app.run(host='0.0.0.0', port=port, debug=True)
+    from waitress import serve
+    serve(app, host='0.0.0.0', port=port, threads=SERVER_THREADS)